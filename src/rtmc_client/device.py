@@ -2,7 +2,19 @@
 Original Author: Ryan Stracener
 """
 
-import json, psutil, socket
+import codecs, json, psutil, select, selectors, socket, struct, sys, time
+
+# Linux reports the number of datagrams the kernel dropped on a UDP socket
+# through this option (not exposed by the socket module)
+SO_RXQ_OVFL = getattr(socket, "SO_RXQ_OVFL", 40 if sys.platform.startswith("linux") else None)
+
+# Size of the reusable receive buffer used by send_stream()
+STREAM_CHUNK_SIZE = 65536
+
+# Receive buffer space to reserve per expected card
+# (the kernel charges its own bookkeeping overhead against the buffer too, and
+# this leaves room for a dual-homed card answering on both addresses)
+DISCOVERY_BYTES_PER_CARD = 2048
 
 class Device:
     def __init__(
@@ -24,6 +36,12 @@ class Device:
 
         # Private fields
         self._sock = None
+        self._api_token = None
+        self._timeout = None
+        self._ticket = None # session-resume ticket from the last `auth`
+        self._ticket_expiry = 0
+        self._resume_pending = False # `resume` reply not read yet
+        self._recv_buffer = b""
 
 
 
@@ -36,11 +54,25 @@ class Device:
         ifaces=None,
         multicast_group="239.255.255.126",
         port=65000,
+        expected_devices=None,
+        stats=None,
+        grace=0.1,
     ):
         # Use set to store unique devices only
         # (don't list the same card twice!)
         device_tuples = set()
 
+        # Serial numbers seen so far (to know when every card has answered)
+        serial_numbers = set()
+        complete = False
+
+        # Counters reported back through `stats`
+        # (`dropped` is the kernel's count as of the last reply received, so
+        # drops after that reply aren't seen; treat it as a lower bound)
+        replies = 0
+        malformed = 0
+        dropped = 0
+
         # If no ifaces were given explicitly, then find all ifaces
         if ifaces is None:
             ifaces = []
@@ -53,8 +85,33 @@ class Device:
         ifaces = set(ifaces)
 
         # Create UDP socket
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-            sock.settimeout(timeout)
+        # (kept non-blocking, so queued replies can be drained in one go)
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock, \
+                selectors.DefaultSelector() as selector:
+            sock.setblocking(False)
+            selector.register(sock, selectors.EVENT_READ)
+
+            # Size the receive buffer so a whole fleet answering at once fits
+            # (the kernel silently caps this at its own maximum, so read the
+            # effective size back for `stats`)
+            if expected_devices is not None:
+                rcvbuf = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+                wanted = expected_devices * DISCOVERY_BYTES_PER_CARD
+                if wanted > rcvbuf:
+                    try:
+                        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, wanted)
+                    except OSError:
+                        pass # keep the default buffer
+            rcvbuf = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+            # Ask the kernel to count dropped datagrams (Linux only)
+            ancbufsize = 0
+            if SO_RXQ_OVFL is not None:
+                try:
+                    sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+                    ancbufsize = socket.CMSG_SPACE(4)
+                except OSError:
+                    pass # not supported, leave `dropped` at zero
 
             for _ in range(tries):
 
@@ -67,9 +124,24 @@ class Device:
                         continue # Invalid iface, skip
 
                 # Listen to all responses within timeout
-                while True:
+                # (once every expected card has answered, only wait `grace`
+                # for the remaining addresses of multi-homed cards)
+                while selector.select(timeout if not complete else grace):
+                    # Drain everything that's already queued
+                    batch = []
                     try:
-                        response, server = sock.recvfrom(1024)
+                        while True:
+                            batch.append(cls._recv_reply(sock, ancbufsize))
+                    except BlockingIOError:
+                        pass
+
+                    for response, ancdata, server in batch:
+                        replies += 1
+
+                        # Read the kernel's cumulative drop counter
+                        for level, kind, data in ancdata:
+                            if level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL and len(data) >= 4:
+                                dropped = max(dropped, struct.unpack("I", data[:4])[0])
 
                         # Try parsing JSON data into tuple
                         try:
@@ -89,26 +161,72 @@ class Device:
                             TypeError,
                             ValueError
                         ):
+                            malformed += 1
                             continue # malformed response, skip
                         
                         # Add device to the set (only adds if tuple is unique)
                         device_tuples.add(device_tuple)
+                        serial_numbers.add(device_tuple[4])
 
-                    except socket.timeout:
-                        break
+                    # Multi-homed cards answer once per address, so count
+                    # serial numbers rather than replies
+                    complete = expected_devices is not None and len(serial_numbers) >= expected_devices
+
+                # No need for another try if no card was missed
+                if complete:
+                    break
+
+        # Report reply counters to the caller
+        if stats is not None:
+            stats["replies"] = replies
+            stats["malformed"] = malformed
+            stats["dropped"] = dropped
+            stats["rcvbuf"] = rcvbuf
 
         # Turn tuple set into list of Device objects
         return [cls(*device) for device in device_tuples]
 
 
 
-    def connect(self, api_token, timeout=1):
+    """
+        Helper method that receives one discovery reply along with its
+        ancillary data. Falls back to recvfrom() where recvmsg() is missing
+        (e.g. Windows), in which case no ancillary data is returned.
+    """
+    @staticmethod
+    def _recv_reply(sock, ancbufsize):
+        if hasattr(sock, "recvmsg"):
+            response, ancdata, _, server = sock.recvmsg(1024, ancbufsize)
+            return response, ancdata, server
+        response, server = sock.recvfrom(1024)
+        return response, [], server
+
+
+
+    def connect(self, api_token, timeout=1, endpoints=None, stagger=0.25, resume=True):
         # Return if socket is already connected
         if self._sock is not None:
             return {
                 "status": "OKAY"
             }
 
+        # A ticket only stands in for the token it was issued for
+        if api_token != self._api_token:
+            self._ticket = None
+
+        # Remember how to authenticate in case a resumed session is rejected
+        self._api_token = api_token
+        self._timeout = timeout
+
+        # Only present a ticket the card hasn't expired yet
+        resume = resume and self._ticket is not None and time.monotonic() < self._ticket_expiry
+
+        # Race the given endpoints instead of (ipv4_addr, port)
+        # (e.g. every address a multi-homed card answered discovery from)
+        if endpoints is not None:
+            ticket = self._ticket if resume else None
+            return self._connect_racing(api_token, timeout, endpoints, stagger, ticket)
+
         sock = None
         try:
             # Create TCP socket
@@ -116,6 +234,17 @@ class Device:
             sock.settimeout(timeout)
             sock.connect((self.ipv4_addr, self.port))
 
+            # Resume the previous session without waiting for the reply
+            # (it's read together with the reply to the first command)
+            if resume:
+                sock.sendall(f"resume {self._ticket}\n".encode())
+                self._sock = sock
+                self._resume_pending = True
+                return {
+                    "status": "OKAY",
+                    "resumed": True
+                }
+
             # Authenticate
             sock.sendall(f"auth {api_token}".encode())
             response = json.loads(sock.recv(1024).decode())
@@ -123,6 +252,7 @@ class Device:
             # Check if authentication was successful
             if response.get("status") == "OKAY":
                 self._sock = sock
+                self._store_ticket(response)
             else:
                 sock.close()
             
@@ -142,6 +272,134 @@ class Device:
 
 
 
+    @staticmethod
+    def discovered_endpoints(devices, serial_number):
+        # Collect every (ipv4_addr, port) pair a card was discovered on
+        # (deduplicated, but in discovery order so the race can rely on it)
+        return list(dict.fromkeys(
+            (device.ipv4_addr, device.port)
+            for device in devices
+            if device.serial_number == serial_number
+        ))
+
+
+
+    """
+        Helper method that connects to several endpoints of the same card in
+        the Happy Eyeballs style. A new attempt is started every `stagger`
+        seconds (or as soon as the previous one fails), the first attempt to
+        authenticate wins, and all others are closed. `timeout` is the
+        overall deadline for the whole race. With a session `ticket`, the
+        first attempt to connect wins instead and pipelines `resume`, just
+        like a single-endpoint connect().
+    """
+    def _connect_racing(self, api_token, timeout, endpoints, stagger, ticket=None):
+        # Remove duplicate endpoints but keep the caller's preference order
+        pending = list(dict.fromkeys((addr, int(port)) for addr, port in endpoints))
+        deadline = time.monotonic() + timeout
+        next_start = time.monotonic()
+        auth_request = f"auth {api_token}".encode()
+        auth_response = None
+        winner = None
+
+        with selectors.DefaultSelector() as selector:
+            try:
+                while winner is None:
+                    now = time.monotonic()
+                    if now >= deadline:
+                        break
+
+                    # Start the next attempt if it's due (or nothing is in flight)
+                    if pending and (now >= next_start or not selector.get_map()):
+                        endpoint = pending.pop(0)
+                        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                        sock.setblocking(False)
+                        try:
+                            sock.connect(endpoint)
+                        except (BlockingIOError, InterruptedError):
+                            pass # connection in progress
+                        except OSError:
+                            sock.close() # failed immediately, try the next one
+                            continue
+                        selector.register(sock, selectors.EVENT_WRITE, endpoint)
+                        next_start = now + stagger
+                        continue
+
+                    # Stop early once every attempt has failed
+                    if not selector.get_map():
+                        break
+
+                    # Wait until an attempt makes progress or the next one is due
+                    wait = deadline - now
+                    if pending:
+                        wait = min(wait, next_start - now)
+                    for key, events in selector.select(max(wait, 0)):
+                        sock, endpoint = key.fileobj, key.data
+                        try:
+                            if events & selectors.EVENT_WRITE:
+                                # Connected (or failed), so send the auth command
+                                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                                if err != 0:
+                                    raise OSError(err, "connect failed")
+
+                                # Resume without waiting for the reply
+                                if ticket is not None:
+                                    sock.sendall(f"resume {ticket}\n".encode())
+                                    selector.unregister(sock)
+                                    winner = (sock, endpoint, {
+                                        "status": "OKAY",
+                                        "resumed": True
+                                    })
+                                    break
+
+                                sock.sendall(auth_request)
+                                selector.modify(sock, selectors.EVENT_READ, endpoint)
+                                continue
+
+                            # Auth reply arrived
+                            response = json.loads(sock.recv(1024).decode())
+                            if response.get("status") == "OKAY":
+                                selector.unregister(sock)
+                                winner = (sock, endpoint, response)
+                                break
+                            auth_response = response
+
+                        except (OSError, UnicodeDecodeError, json.JSONDecodeError):
+                            pass
+
+                        # This attempt failed, start the next one right away
+                        selector.unregister(sock)
+                        sock.close()
+                        next_start = time.monotonic()
+
+            finally:
+                # Cancel every attempt that's still in flight
+                for key in list(selector.get_map().values()):
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+
+        if winner is not None:
+            sock, endpoint, response = winner
+            sock.setblocking(True)
+            sock.settimeout(timeout)
+            self._sock = sock
+            self.ipv4_addr, self.port = endpoint
+            if response.get("resumed"):
+                self._resume_pending = True
+            else:
+                self._store_ticket(response)
+            return response
+
+        # Prefer the card's own rejection over a generic network error
+        if auth_response is not None:
+            return auth_response
+        return {
+            "status": "ERROR",
+            "error-message": "the device cannot be reached"
+        }
+
+
+
     def disconnect(self):
         # Return if socket is already disconnected
         if self._sock is None:
@@ -150,8 +408,11 @@ class Device:
             }
 
         # Void self._sock immediately
+        # (the session ticket is kept so the next connect() can resume)
         sock = self._sock
         self._sock = None
+        self._resume_pending = False
+        self._recv_buffer = b""
 
         try:
             sock.close()
@@ -175,6 +436,254 @@ class Device:
                 "error-message": "socket closed"
             }
         
+        # Pipeline the command behind a pending `resume`
+        if self._resume_pending:
+            try:
+                self._sock.sendall(command.encode())
+            except OSError:
+                pass # card already dropped the connection, handled below
+
+            resumed, response = self._complete_resume()
+            if response.get("status") != "OKAY":
+                return response
+            if resumed:
+                return self._recv_json()
+
         # Send the command and return the response
         self._sock.sendall(command.encode())
-        return json.loads(self._sock.recv(1024).decode())
+        return self._recv_json()
+
+
+
+    def send_stream(self, command, raw=False):
+        # Yield an error if socket is disconnected
+        # (top-level objects are streamed as (key, value) pairs, so
+        # dict(send_stream(...)) gives the same result as send())
+        if self._sock is None:
+            yield from {
+                "status": "ERROR",
+                "error-message": "socket closed"
+            }.items()
+            return
+
+        # Finish a pending `resume` first, so the stream starts clean
+        if self._resume_pending:
+            _, response = self._complete_resume()
+            if response.get("status") != "OKAY":
+                yield from response.items()
+                return
+
+        # Send the command and stream the response
+        self._sock.sendall(command.encode())
+        yield from self._recv_records(raw)
+
+
+
+    """
+        Helper method that caches the session-resume ticket from a successful
+        `auth` or `resume` reply. Cards that don't issue tickets leave the
+        cache empty.
+    """
+    def _store_ticket(self, response):
+        self._ticket = response.get("ticket")
+        if self._ticket is not None:
+            self._ticket_expiry = time.monotonic() + float(response.get("ticket_lifetime", 0))
+
+
+
+    """
+        Helper method that reads the reply to a pipelined `resume` command.
+        Returns (resumed, response). If the card refused the ticket (an
+        error reply, or the connection closed before any reply), it never
+        ran the pipelined command, so the connection is re-established with
+        full authentication and the command must be sent again. Timeouts and
+        other I/O errors propagate instead, since the card may already have
+        run the command.
+    """
+    def _complete_resume(self):
+        self._resume_pending = False
+        try:
+            response = self._recv_json()
+        except ConnectionError as error:
+            # Only a plain EOF means refused (not e.g. a reset)
+            if type(error) is not ConnectionError:
+                raise
+            response = None
+
+        if isinstance(response, dict) and response.get("status") == "OKAY":
+            self._store_ticket(response)
+            return True, response
+
+        # Ticket refused (the card closes the connection), so authenticate
+        self._ticket = None
+        self.disconnect()
+        return False, self.connect(self._api_token, self._timeout)
+
+
+
+    """
+        Helper method that reads exactly one JSON reply from the socket.
+        Top-level containers are reassembled from _recv_records(), so large
+        replies are parsed in a single pass.
+    """
+    def _recv_json(self):
+        records = self._recv_records()
+        items = []
+        try:
+            while True:
+                items.append(next(records))
+        except StopIteration as stop:
+            container = stop.value
+
+        if container == "[":
+            return items
+        if container == "{":
+            return dict(items)
+        return items[0]
+
+
+
+    """
+        Helper generator that incrementally parses one JSON reply. Elements of
+        a top-level array and (key, value) members of a top-level object are
+        yielded as they arrive (or the raw bytes, if `raw` is set), and the
+        kind of container ("[", "{" or None) is returned at the end. Bytes
+        past the end of the reply (pipelined replies) stay in _recv_buffer.
+        An abandoned or failed read drops the connection, since the unread
+        tail would otherwise be read as the next reply.
+    """
+    def _recv_records(self, raw=False):
+        # Reusable receive buffer and incremental UTF-8/JSON decoding state
+        chunk = bytearray(STREAM_CHUNK_SIZE)
+        view = memoryview(chunk)
+        utf8 = codecs.getincrementaldecoder("utf-8")()
+        decoder = json.JSONDecoder()
+        text = ""
+        pos = 0
+        container = None # "[" or "{" once the top-level container opens
+        finished = False
+
+        # Text received since the last parse, joined only when parsing
+        pieces = []
+        pieces_len = 0
+
+        # A partial record is only parsed again once the buffered text has
+        # doubled (or nothing more is waiting), so huge records stay linear
+        retry_at = 0
+
+        # Raw chunks not yet known to lie entirely inside this reply
+        raw_pending = []
+        eof = False
+
+        # Start with whatever is left over from the previous reply
+        data = self._recv_buffer
+        self._recv_buffer = b""
+
+        # Skip whitespace (and record separators inside the container)
+        def skip(pos, separators=""):
+            while pos < len(text) and (text[pos].isspace() or text[pos] in separators):
+                pos += 1
+            return pos
+
+        try:
+            while not finished:
+                # Receive the next chunk into the reusable buffer
+                if not data:
+                    nbytes = self._sock.recv_into(chunk)
+                    if nbytes == 0:
+                        if eof or not pieces:
+                            raise ConnectionError("connection closed mid-response")
+                        eof = True # parse what's buffered before giving up
+                    data = view[:nbytes]
+                if raw:
+                    raw_pending.append(bytes(data))
+                pieces.append(utf8.decode(data))
+                pieces_len += len(pieces[-1])
+                data = b""
+
+                # Wait for more of a partial record before parsing it again
+                # (EOF also makes the socket readable, hence the extra check)
+                if not eof and len(text) - pos + pieces_len < retry_at and self._recv_ready():
+                    continue
+
+                # Drop everything that's already been decoded
+                text = text[pos:] + "".join(pieces)
+                pos = 0
+                pieces = []
+                pieces_len = 0
+                retry_at = 0
+
+                # Decode every complete record in the buffer
+                while True:
+                    pos = skip(pos, "," if container else "")
+                    if pos == len(text):
+                        break
+
+                    # Top-level arrays are streamed one element at a time, and
+                    # top-level objects one (key, value) member at a time
+                    if container is None and text[pos] in "[{":
+                        container = text[pos]
+                        pos += 1
+                        continue
+                    if container is not None and text[pos] == ("]" if container == "[" else "}"):
+                        pos += 1
+                        finished = True
+                        break
+
+                    try:
+                        if container == "{":
+                            key, end = decoder.raw_decode(text, pos)
+                            colon = skip(end)
+                            if colon == len(text):
+                                break # value hasn't arrived yet
+                            if text[colon] != ":":
+                                raise ValueError(f"expected ':' after key at offset {colon}")
+                            value, end = decoder.raw_decode(text, skip(colon + 1))
+                            record = (key, value)
+                        else:
+                            record, end = decoder.raw_decode(text, pos)
+                    except json.JSONDecodeError:
+                        retry_at = 2 * (len(text) - pos)
+                        break # record is incomplete, receive more
+
+                    # Inside a container, a record is only complete once the
+                    # next separator has arrived (otherwise a number could be
+                    # cut off)
+                    if container is not None and end == len(text):
+                        break
+
+                    pos = end
+                    if not raw:
+                        yield record
+                    if container is None:
+                        finished = True # single scalar document
+                        break
+
+                # Everything parsed so far belongs to this reply, so only the
+                # bytes past its end (pipelined replies) are held back
+                if raw:
+                    if finished:
+                        tail = len(text[pos:].encode()) + len(utf8.getstate()[0])
+                        received = b"".join(raw_pending)
+                        yield received[:len(received) - tail]
+                    else:
+                        yield from raw_pending
+                    raw_pending = []
+
+            # Keep any pipelined bytes for the next reply
+            self._recv_buffer = text[pos:].encode() + utf8.getstate()[0]
+            return container
+
+        finally:
+            if not finished:
+                self.disconnect()
+
+
+
+    """
+        Helper method that checks whether more reply data can be received
+        without blocking.
+    """
+    def _recv_ready(self):
+        readable, _, _ = select.select([self._sock], [], [], 0)
+        return bool(readable)
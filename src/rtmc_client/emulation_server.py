@@ -3,18 +3,25 @@ Original Author: Ryan Stracener
 
 This is a bare-bones RTMC Card emulator. It's sole purpose is to facilitate
 the testing of a program's connection logic. It has the following functions:
-  * Responds to UDP discovery queries
+  * Responds to UDP discovery queries (optionally after a random delay)
   * Acts as a TCP server for receiving commands
 
-The only commands supported are the `discover` and `auth` commands. All other
-inputs will respond with the following JSON string:
+The only commands supported are the `discover`, `auth`, `resume` and `dump`
+commands. A successful `auth` issues a short-lived session ticket which a
+reconnecting client can present as `resume <ticket>\n` instead, optionally
+followed by its first command on the same line-delimited write.
+`dump <count> [size] [object]` returns a JSON array of `count` records, each
+padded with `size` bytes of data, to exercise large responses. With `object`
+the records are returned as members of one JSON object instead (like a
+parameter table). All other inputs will respond with the following JSON
+string:
     {
         "status": "ERROR",
         "error-message": "command not supported by emulator"
     }
 """
 
-import fnmatch, json, socket, struct, threading
+import fnmatch, json, random, secrets, socket, struct, threading, time
 
 class EmulationServer:
     def __init__(
@@ -27,6 +34,8 @@ class EmulationServer:
         firmware_version="0.0.0",
         udp_multicast_group="239.255.255.126",
         udp_port=65000,
+        udp_reply_delay=0,
+        ticket_lifetime=10,
     ):
         # Public fields
         self.api_token = api_token
@@ -37,6 +46,8 @@ class EmulationServer:
         self.firmware_version = firmware_version
         self.udp_multicast_group = udp_multicast_group
         self.udp_port = udp_port
+        self.udp_reply_delay = udp_reply_delay # max random delay (seconds) before answering discovery
+        self.ticket_lifetime = ticket_lifetime # seconds a session ticket stays valid (None disables tickets)
         self.ipv4_addr = "127.0.0.1"
         self.is_running = False # TODO: there's a difference in stop_flag and is_stopped, since stopping takes time in a background thread
 
@@ -45,6 +56,7 @@ class EmulationServer:
         self._tcp_socket = None
         self._udp_daemon = None
         self._udp_socket = None
+        self._tickets = {} # session ticket -> expiry time
 
 
 
@@ -119,6 +131,9 @@ class EmulationServer:
             try:
                 conn, addr = self._tcp_socket.accept()
 
+            except socket.timeout: # No client yet, keep waiting
+                continue
+
             except OSError: # Socket closed while waiting in accept()
                 break
 
@@ -131,6 +146,9 @@ class EmulationServer:
                     try:
                         data = conn.recv(1024)
 
+                    except socket.timeout: # Client is idle, keep waiting
+                        continue
+
                     except OSError: # Connection abruptly closed
                         break
                     
@@ -140,12 +158,17 @@ class EmulationServer:
                     
                     # Call the appropriate command
                     if not client_authenticated:
-                        response = self._auth_command(data.decode())
+                        # A command may be pipelined behind the first line
+                        command, _, pipelined = data.decode().partition("\n")
+                        response = self._auth_command(command)
                         conn.sendall(response.encode())
 
                         # Check if authentication succeeded
                         if json.loads(response).get("status") == "OKAY":
                             client_authenticated = True
+                            if pipelined:
+                                response = self._command_invoke(pipelined)
+                                conn.sendall(response.encode())
                         else:
                             # Flag the failure to break out of the loop
                             # (this closes the connection)
@@ -170,7 +193,15 @@ class EmulationServer:
 
                 # Only reply if the query matched
                 if(response != "{}"):
-                    self._udp_socket.sendto(response.encode(), addr)
+                    if self.udp_reply_delay > 0:
+                        # Spread replies out like real card firmware does
+                        # (don't block the server loop while waiting)
+                        delay = random.uniform(0, self.udp_reply_delay)
+                        timer = threading.Timer(delay, self._udp_reply, (response, addr))
+                        timer.daemon = True
+                        timer.start()
+                    else:
+                        self._udp_reply(response, addr)
 
             # If the socket times out, just try again
             except socket.timeout:
@@ -181,11 +212,21 @@ class EmulationServer:
 
 
 
+    def _udp_reply(self, response, addr):
+        try:
+            self._udp_socket.sendto(response.encode(), addr)
+        except OSError: # Socket closed before a delayed reply went out
+            pass
+
+
+
     def _command_invoke(self, command):
         # List of supported commands
         command_handlers = {
             "auth": self._auth_command,
+            "resume": self._auth_command,
             "discover": self._discover_command,
+            "dump": self._dump_command,
         }
         
         # Choose handler from first word of the command
@@ -201,12 +242,30 @@ class EmulationServer:
 
 
     def _auth_command(self, command):
-        token = command[5:]
-        if(token == self.api_token):
-            return '{"status":"OKAY"}'
-        else:
+        first_word, _, argument = command.partition(" ")
+
+        # Forget expired tickets
+        now = time.monotonic()
+        self._tickets = {
+            ticket: expiry
+            for ticket, expiry in self._tickets.items()
+            if expiry > now
+        }
+
+        # Check the API token, or redeem a (single-use) session ticket
+        if first_word == "resume":
+            if self._tickets.pop(argument, None) is None:
+                return '{"status":"ERROR","error-message":"session ticket rejected"}'
+        elif first_word != "auth" or argument != self.api_token:
             return '{"status":"ERROR","error-message":"authentication failed"}'
 
+        # Issue a fresh ticket for the next reconnect
+        if self.ticket_lifetime is None:
+            return '{"status":"OKAY"}'
+        ticket = secrets.token_hex(16)
+        self._tickets[ticket] = now + self.ticket_lifetime
+        return f'{{"status":"OKAY","ticket":"{ticket}","ticket_lifetime":{self.ticket_lifetime}}}'
+
 
 
     def _discover_command(self, command):
@@ -231,3 +290,34 @@ class EmulationServer:
             )
         else:
             return '{}'
+
+
+
+    def _dump_command(self, command):
+        # Parse `dump <count> [size] [object]`
+        args = command.split()[1:]
+        as_object = args[-1:] == ["object"]
+        if as_object:
+            args = args[:-1]
+        try:
+            args = [int(arg) for arg in args]
+            count = args[0]
+            size = args[1] if len(args) > 1 else 64
+            if count < 0 or size < 0 or len(args) > 2:
+                raise ValueError
+        except (IndexError, ValueError):
+            return '{"status":"ERROR","error-message":"usage: dump <count> [size] [object]"}'
+
+        # Build the (possibly very large) JSON array or object
+        data = "x" * size
+        if as_object:
+            records = ",".join(
+                f'"param{i}":{{"index":{i},"data":"{data}"}}'
+                for i in range(count)
+            )
+            return f"{{{records}}}"
+        records = ",".join(
+            f'{{"index":{i},"data":"{data}"}}'
+            for i in range(count)
+        )
+        return f"[{records}]"
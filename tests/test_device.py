@@ -1,5 +1,12 @@
+import json
 import pytest
 import rtmc_client as rtmc
+import socket
+import struct
+import sys
+import threading
+import time
+import tracemalloc
 
 @pytest.fixture
 def device(emulator):
@@ -36,3 +43,433 @@ def test_discover(emulator):
 def test_discover_ifaces(emulator):
     devices = rtmc.Device.discover("rtmc*", ifaces=["0.0.0.0"], timeout=0.1, tries=1)
     assert len(devices) > 0
+
+
+
+# Test racing a connection across several endpoints of the same card
+def test_connect_endpoints(emulator):
+    # The first endpoint is dead, so the second one must win the race
+    endpoints = [
+        (emulator.ipv4_addr, emulator.tcp_port + 1),
+        (emulator.ipv4_addr, emulator.tcp_port),
+    ]
+    device = rtmc.Device(None, None)
+    response = device.connect(emulator.api_token, timeout=1, endpoints=endpoints)
+    assert response.get("status") == "OKAY"
+    assert (device.ipv4_addr, device.port) == (emulator.ipv4_addr, emulator.tcp_port)
+
+    response = device.send(f"auth {emulator.api_token}")
+    assert response.get("status") == "OKAY"
+    assert device.disconnect().get("status") == "OKAY"
+
+
+
+# Test that an unresponsive endpoint only costs the stagger delay
+def test_connect_endpoints_unresponsive(emulator):
+    # A listening socket that's never accepted: the kernel completes the
+    # handshake, but `auth` never gets a reply
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as silent:
+        silent.bind((emulator.ipv4_addr, 0))
+        silent.listen()
+
+        endpoints = [
+            silent.getsockname(),
+            (emulator.ipv4_addr, emulator.tcp_port),
+        ]
+        device = rtmc.Device(None, None)
+        start = time.monotonic()
+        response = device.connect(emulator.api_token, timeout=30, endpoints=endpoints, stagger=0.3)
+        elapsed = time.monotonic() - start
+
+    # The second endpoint won, but only after the stagger delay, and long
+    # before the overall deadline
+    assert response.get("status") == "OKAY"
+    assert (device.ipv4_addr, device.port) == (emulator.ipv4_addr, emulator.tcp_port)
+    assert 0.3 <= elapsed < 30
+    assert device.disconnect().get("status") == "OKAY"
+
+
+
+# Test that a racing connection reports failed authentication
+def test_connect_endpoints_wrong_token(emulator):
+    device = rtmc.Device(None, None)
+    endpoints = [(emulator.ipv4_addr, emulator.tcp_port)]
+    response = device.connect("wrong_token", endpoints=endpoints)
+    assert response.get("status") == "ERROR"
+    assert response.get("error-message") == "authentication failed"
+
+
+
+# Test collecting the endpoints of one card from discovery results
+def test_discovered_endpoints():
+    devices = [
+        rtmc.Device("10.0.1.2", 65001, serial_number="A"),
+        rtmc.Device("10.0.0.3", 65001, serial_number="B"),
+        rtmc.Device("10.0.0.2", 65001, serial_number="A"),
+        rtmc.Device("10.0.1.2", 65001, serial_number="A"),
+    ]
+    endpoints = rtmc.Device.discovered_endpoints(devices, "A")
+    assert endpoints == [("10.0.1.2", 65001), ("10.0.0.2", 65001)]
+
+
+
+# Test discovering a small fleet in a single try
+def test_discover_fleet():
+    # Start several cards that all answer discovery after a random delay
+    emulators = [
+        rtmc.EmulationServer(
+            "dummy_token",
+            tcp_port=65101 + i,
+            serial_number=f"FLEET{i:03}",
+            udp_reply_delay=0.05
+        )
+        for i in range(5)
+    ]
+    for emulator in emulators:
+        emulator.start()
+
+    try:
+        stats = {}
+        devices = rtmc.Device.discover(
+            "rtmc*",
+            ifaces=["0.0.0.0"],
+            timeout=0.2,
+            tries=1,
+            expected_devices=len(emulators),
+            stats=stats
+        )
+        serial_numbers = {device.serial_number for device in devices}
+        assert serial_numbers == {emulator.serial_number for emulator in emulators}
+        assert stats["replies"] >= len(emulators)
+        assert stats["malformed"] == 0
+        assert stats["dropped"] == 0
+        assert stats["rcvbuf"] > 0
+    finally:
+        for emulator in emulators:
+            emulator.stop()
+
+
+
+# Test that the second address of a multi-homed card is still collected
+# after every expected card has answered
+def test_discover_fleet_multihomed_endpoints():
+    emulators = [
+        rtmc.EmulationServer("dummy_token", tcp_port=65121, serial_number="A"),
+        rtmc.EmulationServer("dummy_token", tcp_port=65122, serial_number="A", udp_reply_delay=0.05),
+        rtmc.EmulationServer("dummy_token", tcp_port=65123, serial_number="B"),
+    ]
+    for emulator in emulators:
+        emulator.start()
+
+    try:
+        devices = rtmc.Device.discover(
+            "rtmc*",
+            ifaces=["0.0.0.0"],
+            timeout=0.5,
+            tries=1,
+            expected_devices=2
+        )
+        endpoints = rtmc.Device.discovered_endpoints(devices, "A")
+        assert sorted(port for _, port in endpoints) == [65121, 65122]
+    finally:
+        for emulator in emulators:
+            emulator.stop()
+
+
+
+# Test that malformed and dropped replies are counted
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="drop counter is Linux only")
+def test_discover_stats():
+    burst = 300
+
+    # Responder that floods the client with garbage (more than its receive
+    # buffer holds), then sends one valid reply once the flood has drained
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("", 65000))
+    sock.setsockopt(
+        socket.IPPROTO_IP,
+        socket.IP_ADD_MEMBERSHIP,
+        struct.pack("4s4s", socket.inet_aton("239.255.255.126"), socket.inet_aton("0.0.0.0"))
+    )
+    sock.settimeout(1)
+
+    def respond():
+        _, addr = sock.recvfrom(1024)
+        for _ in range(burst):
+            sock.sendto(b"\xff" * 8192, addr)
+        time.sleep(0.05)
+        sock.sendto(
+            b'{"service":"rtmc-garbage","port":1,"device":"d","serial_number":"G","firmware_version":"0"}',
+            addr
+        )
+
+    responder = threading.Thread(target=respond, daemon=True)
+    responder.start()
+
+    try:
+        stats = {}
+        devices = rtmc.Device.discover("rtmc*", ifaces=["0.0.0.0"], timeout=0.3, tries=1, stats=stats)
+        responder.join()
+    finally:
+        sock.close()
+
+    # Every datagram sent was either received or counted as dropped
+    assert [device.serial_number for device in devices] == ["G"]
+    assert stats["replies"] + stats["dropped"] == burst + 1
+    assert stats["malformed"] + stats["dropped"] == burst
+    assert stats["malformed"] > 0
+    assert stats["rcvbuf"] > 0
+
+
+
+# Test streaming a large response record by record
+def test_send_stream(emulator, device):
+    count = 20000
+    records = device.send_stream(f"dump {count} 100")
+    for i, record in enumerate(records):
+        assert record == {"index": i, "data": "x" * 100}
+    assert i == count - 1
+
+    # The connection is still usable afterwards
+    response = device.send(f"auth {emulator.api_token}")
+    assert response.get("status") == "OKAY"
+
+
+
+# Test streaming the raw chunks of a response
+def test_send_stream_raw(emulator, device):
+    chunks = list(device.send_stream("dump 1000 100", raw=True))
+    records = json.loads(b"".join(chunks).decode())
+    assert len(records) == 1000
+
+
+
+# Test streaming a large top-level object member by member
+def test_send_stream_object(emulator, device):
+    count = 20000
+    records = device.send_stream(f"dump {count} 100 object")
+    for i, (key, value) in enumerate(records):
+        assert key == f"param{i}"
+        assert value == {"index": i, "data": "x" * 100}
+    assert i == count - 1
+
+    # The connection is still usable afterwards
+    response = device.send(f"auth {emulator.api_token}")
+    assert response.get("status") == "OKAY"
+
+
+
+# Serve one canned reply to a Device over a socket pair
+def _serve_once(payload):
+    client, server = socket.socketpair()
+    device = rtmc.Device(None, None)
+    device._sock = client
+
+    def serve():
+        with server:
+            server.recv(1024)
+            server.sendall(payload)
+
+    threading.Thread(target=serve, daemon=True).start()
+    return device
+
+
+
+# Test streaming a single multi-megabyte member (e.g. a trace buffer)
+def test_send_stream_large_member():
+    count = 80_000
+    sample = "x" * 98
+    payload = ('{"status":"OKAY","trace":[' + ",".join([f'"{sample}"'] * count) + ']}').encode()
+    size = len(payload)
+
+    # Parsing stays within a small factor of a plain json.loads()
+    start = time.monotonic()
+    json.loads(payload)
+    loads_time = time.monotonic() - start
+
+    device = _serve_once(payload)
+    start = time.monotonic()
+    records = dict(device.send_stream("trace"))
+    assert time.monotonic() - start < 20 * loads_time + 0.5
+    assert records["trace"] == [sample] * count
+
+    # Memory stays within a small multiple of the record itself
+    device = _serve_once(payload)
+    tracemalloc.start()
+    try:
+        records = dict(device.send_stream("trace"))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert len(records["trace"]) == count
+    assert peak < 4 * size
+
+
+
+# Test that raw mode stops at the end of the reply
+def test_send_stream_raw_pipelined():
+    # A second (pipelined) reply arrives right behind the first one
+    device = _serve_once(b'[1,2,3]{"status":"OKAY"}')
+    chunks = list(device.send_stream("first", raw=True))
+    assert b"".join(chunks) == b"[1,2,3]"
+
+    # The pipelined reply is still there for the next read
+    assert device._recv_json() == {"status": "OKAY"}
+
+
+
+# Test that small object responses (e.g. errors) reassemble with dict()
+def test_send_stream_error(emulator, device):
+    response = dict(device.send_stream("dump"))
+    assert response.get("status") == "ERROR"
+
+
+
+# Test that abandoning a stream drops the out-of-sync connection
+def test_send_stream_abandoned(emulator, device):
+    records = device.send_stream("dump 20000 100")
+    next(records)
+    records.close()
+
+    response = device.send(f"auth {emulator.api_token}")
+    assert response.get("status") == "ERROR"
+
+
+
+# Test resuming a session with the cached ticket after reconnecting
+def test_connect_resume(emulator, device):
+    assert device.disconnect().get("status") == "OKAY"
+
+    response = device.connect(emulator.api_token)
+    assert response.get("status") == "OKAY"
+    assert response.get("resumed")
+
+    # The resume reply is read together with the first command's reply
+    response = device.send("discover rtmc*")
+    assert response.get("serial_number") == emulator.serial_number
+    response = device.send("dump 2")
+    assert len(response) == 2
+
+
+
+# Test falling back to full authentication when the ticket is rejected
+def test_connect_resume_rejected(emulator, device):
+    assert device.disconnect().get("status") == "OKAY"
+    emulator._tickets.clear() # e.g. the card rebooted
+
+    response = device.connect(emulator.api_token)
+    assert response.get("resumed")
+
+    response = device.send("discover rtmc*")
+    assert response.get("serial_number") == emulator.serial_number
+
+
+
+# Test that multi-homed cards don't end discovery early
+def test_discover_fleet_multihomed():
+    # Cards A and B answer twice (once per "address") right away, card C
+    # answers later, so counting replies would stop before C is heard
+    emulators = [
+        rtmc.EmulationServer("dummy_token", tcp_port=65111, serial_number="A"),
+        rtmc.EmulationServer("dummy_token", tcp_port=65112, serial_number="A"),
+        rtmc.EmulationServer("dummy_token", tcp_port=65113, serial_number="B"),
+        rtmc.EmulationServer("dummy_token", tcp_port=65114, serial_number="B"),
+        rtmc.EmulationServer("dummy_token", tcp_port=65115, serial_number="C", udp_reply_delay=0.1),
+    ]
+    for emulator in emulators:
+        emulator.start()
+
+    try:
+        devices = rtmc.Device.discover(
+            "rtmc*",
+            ifaces=["0.0.0.0"],
+            timeout=0.5,
+            tries=1,
+            expected_devices=3
+        )
+        assert {device.serial_number for device in devices} == {"A", "B", "C"}
+    finally:
+        for emulator in emulators:
+            emulator.stop()
+
+
+
+# Test that a cached ticket isn't presented for a different token
+def test_connect_resume_wrong_token(emulator, device):
+    assert device.disconnect().get("status") == "OKAY"
+
+    response = device.connect("wrong_token")
+    assert response.get("status") == "ERROR"
+    assert not response.get("resumed")
+    assert device.send("discover rtmc*").get("error-message") == "socket closed"
+
+
+
+# Test a large reply right after resuming (arrives behind the resume reply)
+def test_connect_resume_large_reply(emulator, device):
+    assert device.disconnect().get("status") == "OKAY"
+    assert device.connect(emulator.api_token).get("resumed")
+
+    start = time.monotonic()
+    response = device.send("dump 15000 100")
+    assert len(response) == 15000
+    assert response[-1] == {"index": 14999, "data": "x" * 100}
+    assert time.monotonic() - start < 5
+
+    # Later replies are read the same way
+    response = device.send("dump 2000 100 object")
+    assert len(response) == 2000
+
+
+
+# Test that a slow resume reply isn't mistaken for a refused ticket
+def test_connect_resume_timeout():
+    # A card that accepts the connection but never replies
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as silent:
+        silent.bind(("127.0.0.1", 0))
+        silent.listen()
+        silent.settimeout(0.2)
+
+        device = rtmc.Device(*silent.getsockname())
+        device._api_token = "dummy_token"
+        device._ticket = "cached_ticket"
+        device._ticket_expiry = time.monotonic() + 60
+        assert device.connect("dummy_token", timeout=0.2).get("resumed")
+
+        # The timeout propagates instead of reconnecting and resending
+        with pytest.raises(socket.timeout):
+            device.send("discover rtmc*")
+
+        conn, _ = silent.accept()
+        with conn:
+            conn.settimeout(0.2)
+            data = b""
+            while True:
+                chunk = conn.recv(1024)
+                if not chunk:
+                    break
+                data += chunk
+        assert data == b"resume cached_ticket\ndiscover rtmc*"
+
+        # No second connection was made
+        with pytest.raises(socket.timeout):
+            silent.accept()
+
+
+
+# Test resuming a session through a racing connect
+def test_connect_endpoints_resume(emulator, device):
+    assert device.disconnect().get("status") == "OKAY"
+
+    endpoints = [
+        (emulator.ipv4_addr, emulator.tcp_port + 1),
+        (emulator.ipv4_addr, emulator.tcp_port),
+    ]
+    response = device.connect(emulator.api_token, endpoints=endpoints)
+    assert response.get("status") == "OKAY"
+    assert response.get("resumed")
+    assert (device.ipv4_addr, device.port) == (emulator.ipv4_addr, emulator.tcp_port)
+
+    response = device.send("discover rtmc*")
+    assert response.get("serial_number") == emulator.serial_number
@@ -2,6 +2,7 @@ import json
 import pytest
 import rtmc_client as rtmc
 import socket
+import time
 
 @pytest.fixture
 def tcp_socket(emulator):
@@ -150,3 +151,113 @@ def test_discover_udp_bad_query(emulator, udp_socket):
         socket_timeout = True
     
     assert socket_timeout
+
+
+
+# Test that discovery replies can be delayed
+def test_discover_udp_reply_delay(emulator, udp_socket):
+    emulator.udp_reply_delay = 0.05
+    udp_socket.settimeout(1)
+    udp_socket.sendto(b"discover rtmc*", (emulator.udp_multicast_group, emulator.udp_port))
+
+    response, server = udp_socket.recvfrom(1024)
+    json_data = json.loads(response.decode())
+    assert json_data.get("serial_number") == emulator.serial_number
+
+
+
+# Test the dump command over the TCP socket
+def test_dump_tcp(emulator, tcp_socket):
+    # Authenticate
+    tcp_socket.sendall(f"auth {emulator.api_token}".encode())
+    response = json.loads(tcp_socket.recv(1024).decode())
+    assert response.get("status") == "OKAY"
+
+    # Request a small dump
+    tcp_socket.sendall("dump 3 4".encode())
+    response = json.loads(tcp_socket.recv(1024).decode())
+
+    # Verify the response data
+    assert response == [{"index": i, "data": "xxxx"} for i in range(3)]
+
+
+
+# Test resuming a session with a ticket from a previous `auth`
+def test_resume(emulator, tcp_socket):
+    tcp_socket.sendall(f"auth {emulator.api_token}".encode())
+    ticket = json.loads(tcp_socket.recv(1024).decode()).get("ticket")
+    tcp_socket.close() # the emulator serves one connection at a time
+    assert ticket is not None
+
+    # Present the ticket on a new connection
+    with socket.create_connection((emulator.ipv4_addr, emulator.tcp_port)) as sock:
+        sock.sendall(f"resume {ticket}\n".encode())
+        response = json.loads(sock.recv(1024).decode())
+        assert response.get("status") == "OKAY"
+        assert response.get("ticket") not in (None, ticket)
+
+
+
+# Test that a ticket can only be redeemed once
+def test_resume_reused_ticket(emulator, tcp_socket):
+    tcp_socket.sendall(f"auth {emulator.api_token}".encode())
+    ticket = json.loads(tcp_socket.recv(1024).decode()).get("ticket")
+    tcp_socket.close() # the emulator serves one connection at a time
+
+    for status in ("OKAY", "ERROR"):
+        with socket.create_connection((emulator.ipv4_addr, emulator.tcp_port)) as sock:
+            sock.sendall(f"resume {ticket}".encode())
+            response = json.loads(sock.recv(1024).decode())
+            assert response.get("status") == status
+
+
+
+# Test that expired tickets are rejected
+def test_resume_expired_ticket(emulator, tcp_socket):
+    emulator.ticket_lifetime = 0.05
+    tcp_socket.sendall(f"auth {emulator.api_token}".encode())
+    ticket = json.loads(tcp_socket.recv(1024).decode()).get("ticket")
+    tcp_socket.close() # the emulator serves one connection at a time
+    time.sleep(0.1)
+
+    with socket.create_connection((emulator.ipv4_addr, emulator.tcp_port)) as sock:
+        sock.sendall(f"resume {ticket}".encode())
+        response = json.loads(sock.recv(1024).decode())
+        assert response.get("error-message") == "session ticket rejected"
+
+
+
+# Test a command pipelined behind `resume`
+def test_resume_pipelined(emulator, tcp_socket):
+    tcp_socket.sendall(f"auth {emulator.api_token}".encode())
+    ticket = json.loads(tcp_socket.recv(1024).decode()).get("ticket")
+    tcp_socket.close() # the emulator serves one connection at a time
+
+    with socket.create_connection((emulator.ipv4_addr, emulator.tcp_port)) as sock:
+        sock.sendall(f"resume {ticket}\ndiscover rtmc*".encode())
+
+        # Both replies arrive back to back
+        data = b""
+        while data.count(b"}") < 2:
+            data += sock.recv(1024)
+        decoder = json.JSONDecoder()
+        response, end = decoder.raw_decode(data.decode())
+        assert response.get("status") == "OKAY"
+        response = json.loads(data.decode()[end:])
+        assert response.get("serial_number") == emulator.serial_number
+
+
+
+# Test the dump command's object form over the TCP socket
+def test_dump_object_tcp(emulator, tcp_socket):
+    # Authenticate
+    tcp_socket.sendall(f"auth {emulator.api_token}".encode())
+    response = json.loads(tcp_socket.recv(1024).decode())
+    assert response.get("status") == "OKAY"
+
+    # Request a small dump as an object
+    tcp_socket.sendall("dump 2 4 object".encode())
+    response = json.loads(tcp_socket.recv(1024).decode())
+
+    # Verify the response data
+    assert response == {f"param{i}": {"index": i, "data": "xxxx"} for i in range(2)}